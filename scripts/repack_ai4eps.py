@@ -0,0 +1,112 @@
+"""
+repack_ai4eps.py: this file repacks the AI4EPS hdf5 waveforms into a single NX3XNT dataset with a sidecar index table,
+so the dataloader reads one chunk per waveform instead of traversing the event/station groups.
+"""
+import argparse
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+
+def list_input_files(input_path):
+    # either the folder of per event files generated by ai4eps_h5_to_chunks.py or the original waveform.h5
+    if input_path.is_dir():
+        return sorted(input_path.glob("*.h5"))
+    return [input_path]
+
+
+def iter_waveforms(input_files):
+    for input_file in input_files:
+        with h5py.File(input_file, "r") as input_h5_file:
+            for event_id, event_group in input_h5_file.items():
+                if not isinstance(event_group, h5py.Group):
+                    continue
+                for station_id, dset in event_group.items():
+                    if isinstance(dset, h5py.Dataset):
+                        yield event_id, station_id, dset
+
+
+def scan_waveforms(input_files):
+    # the first pass only reads the shapes and attributes to size the output datasets
+    num_waveforms, max_npts, max_phases = 0, 0, 0
+    for _, _, dset in iter_waveforms(input_files):
+        num_waveforms += 1
+        max_npts = max(max_npts, dset.shape[-1])
+        max_phases = max(max_phases, len(dset.attrs["phase_index"]))
+    return num_waveforms, max_npts, max_phases
+
+
+def repack(input_files, output_h5_file_path, dtype="float32"):
+    num_waveforms, max_npts, max_phases = scan_waveforms(input_files)
+    print(
+        f"repacking {num_waveforms} waveforms, max npts: {max_npts}, max phases: {max_phases}"
+    )
+
+    event_ids, station_ids, networks = [], [], []
+    npts = np.zeros(num_waveforms, dtype=np.int64)
+    phase_count = np.zeros(num_waveforms, dtype=np.int64)
+    phase_index = np.full((num_waveforms, max_phases), -999999999, dtype=np.int64)
+    phase_type = np.full((num_waveforms, max_phases), "", dtype=object)
+
+    with h5py.File(output_h5_file_path, "w") as output_h5_file:
+        # one chunk per waveform, lzf is fast to decompress and ships with h5py
+        waveforms = output_h5_file.create_dataset(
+            "waveforms",
+            shape=(num_waveforms, 3, max_npts),
+            dtype=dtype,
+            chunks=(1, 3, max_npts),
+            shuffle=True,
+            compression="lzf",
+            fillvalue=0.0,
+        )
+        for row, (event_id, station_id, dset) in enumerate(
+            iter_waveforms(input_files)
+        ):
+            data = dset[...]
+            if dtype == "float16":
+                # raw counts can overflow float16, so each waveform is scaled to [-1, 1]
+                # the scale is not stored, the dataset normalizes every waveform by its own std anyway
+                max_abs = np.nanmax(np.abs(data)) if data.size > 0 else 0.0
+                if np.isfinite(max_abs) and max_abs > 0:
+                    data = data / max_abs
+            waveforms[row, :, : data.shape[-1]] = data
+            npts[row] = data.shape[-1]
+
+            attrs = dset.attrs
+            count = len(attrs["phase_index"])
+            phase_count[row] = count
+            phase_index[row, :count] = attrs["phase_index"]
+            phase_type[row, :count] = [str(item) for item in attrs["phase_type"]]
+            event_ids.append(event_id)
+            station_ids.append(station_id)
+            networks.append(str(attrs["network"]))
+
+        str_dtype = h5py.string_dtype()
+        output_h5_file.create_dataset("npts", data=npts)
+        output_h5_file.create_dataset("phase_count", data=phase_count)
+        output_h5_file.create_dataset("phase_index", data=phase_index)
+        output_h5_file.create_dataset("phase_type", data=phase_type, dtype=str_dtype)
+        output_h5_file.create_dataset("event_id", data=event_ids, dtype=str_dtype)
+        output_h5_file.create_dataset("station_id", data=station_ids, dtype=str_dtype)
+        output_h5_file.create_dataset("network", data=networks, dtype=str_dtype)
+
+
+def main(args):
+    input_path = Path(args.input)
+    output_h5_file_path = Path(args.output_h5_file)
+    repack(list_input_files(input_path), output_h5_file_path, dtype=args.dtype)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Repack AI4EPS waveforms into a single chunked dataset")
+    parser.add_argument(
+        "input", help="Path to the input waveform.h5 or the folder of per event h5 files")
+    parser.add_argument(
+        "output_h5_file", help="Path to the output file, eg. dataset/waveform_packed.h5")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32",
+                        help="Storage dtype of the waveforms, float16 halves the bytes read per sample (default: float32)")
+
+    args = parser.parse_args()
+    main(args)
@@ -1,6 +1,7 @@
 """
 ai4eps_datamodule.py: this file contains the datamodule for the dataset following standard AI4EPS format.
 """
+from functools import partial
 from pathlib import Path
 from typing import List, Optional
 
@@ -8,7 +9,11 @@ from lightning import LightningDataModule
 from torch.utils.data import DataLoader
 from torchvision.transforms import transforms
 
-from src.data.components.ai4eps import Ai4epsDataset, split_train_test_val_for_ai4eps
+from src.data.components.ai4eps import (
+    Ai4epsDataset,
+    ai4eps_collate,
+    split_train_test_val_for_ai4eps,
+)
 from src.data.transforms import RandomReplaceNoise, RandomShift
 
 
@@ -32,10 +37,13 @@ class Ai4epsDataModule(LightningDataModule):
         phases: List[str] = ["P", "S", "PS"],
         first_arrival_index_in_final_window_if_no_shift: int = 400,
         random_stack_two_waveforms_ratio=0.0,
+        packed_waveform: bool = False,
         # data loader params
         batch_size: int = 32,
         num_workers: int = 4,
         pin_memory: bool = True,
+        prefetch_factor: int = 2,
+        persistent_workers: bool = True,
     ):
         super().__init__()
 
@@ -73,6 +81,7 @@ class Ai4epsDataModule(LightningDataModule):
                 self.hparams["phases"],
                 self.hparams["first_arrival_index_in_final_window_if_no_shift"],
                 self.hparams["random_stack_two_waveforms_ratio"],
+                packed_waveform=self.hparams["packed_waveform"],
             )
             self.data_val = Ai4epsDataset(
                 Path(self.hparams["data_dir"]),
@@ -84,6 +93,7 @@ class Ai4epsDataModule(LightningDataModule):
                 self.hparams["phases"],
                 self.hparams["first_arrival_index_in_final_window_if_no_shift"],
                 0.0,
+                packed_waveform=self.hparams["packed_waveform"],
             )
             self.data_test = Ai4epsDataset(
                 Path(self.hparams["data_dir"]),
@@ -95,8 +105,14 @@ class Ai4epsDataModule(LightningDataModule):
                 self.hparams["phases"],
                 self.hparams["first_arrival_index_in_final_window_if_no_shift"],
                 0.0,
+                packed_waveform=self.hparams["packed_waveform"],
             )
 
+    def _worker_init_fn(self):
+        # pass the global rank, so lightning seeds the workers differently on each rank
+        rank = self.trainer.global_rank if self.trainer is not None else None
+        return partial(Ai4epsDataset.worker_init_fn, rank=rank)
+
     def train_dataloader(self):
         assert (
             self.data_train is not None
@@ -106,8 +122,16 @@ class Ai4epsDataModule(LightningDataModule):
             batch_size=self.hparams["batch_size"],
             num_workers=self.hparams["num_workers"],
             pin_memory=self.hparams["pin_memory"],
+            # number of batches read ahead by each worker, only valid with multiprocessing
+            prefetch_factor=self.hparams["prefetch_factor"]
+            if self.hparams["num_workers"] > 0
+            else None,
             shuffle=True,
-            # persistent_workers=True,
+            # keep workers alive across epochs, so hdf5 handlers are not reopened every epoch
+            persistent_workers=self.hparams["persistent_workers"]
+            and self.hparams["num_workers"] > 0,
+            worker_init_fn=self._worker_init_fn(),
+            collate_fn=ai4eps_collate,
         )
 
     def val_dataloader(self):
@@ -119,8 +143,16 @@ class Ai4epsDataModule(LightningDataModule):
             batch_size=self.hparams["batch_size"],
             num_workers=self.hparams["num_workers"],
             pin_memory=self.hparams["pin_memory"],
+            # number of batches read ahead by each worker, only valid with multiprocessing
+            prefetch_factor=self.hparams["prefetch_factor"]
+            if self.hparams["num_workers"] > 0
+            else None,
             shuffle=False,
-            # persistent_workers=True,
+            # keep workers alive across epochs, so hdf5 handlers are not reopened every epoch
+            persistent_workers=self.hparams["persistent_workers"]
+            and self.hparams["num_workers"] > 0,
+            worker_init_fn=self._worker_init_fn(),
+            collate_fn=ai4eps_collate,
         )
 
     def test_dataloader(self):
@@ -132,8 +164,16 @@ class Ai4epsDataModule(LightningDataModule):
             batch_size=self.hparams["batch_size"],
             num_workers=self.hparams["num_workers"],
             pin_memory=self.hparams["pin_memory"],
+            # number of batches read ahead by each worker, only valid with multiprocessing
+            prefetch_factor=self.hparams["prefetch_factor"]
+            if self.hparams["num_workers"] > 0
+            else None,
             shuffle=False,
-            # persistent_workers=True,
+            # keep workers alive across epochs, so hdf5 handlers are not reopened every epoch
+            persistent_workers=self.hparams["persistent_workers"]
+            and self.hparams["num_workers"] > 0,
+            worker_init_fn=self._worker_init_fn(),
+            collate_fn=ai4eps_collate,
         )
 
 
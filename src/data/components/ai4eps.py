@@ -2,17 +2,26 @@
 ai4eps.py: this file contains dataset following standard AI4EPS format.
 Reference: https://ai4eps.github.io/homepage/ml4earth/seismic_event_format1/
 """
+import os
+import random
 from pathlib import Path
-from typing import Callable, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import h5py
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import Dataset
+from lightning.fabric.utilities.seed import pl_worker_init_function
+from torch.utils.data import Dataset, default_collate, get_worker_info
 
 from src import utils
-from src.data.components.utils import generate_label, normalize_waveform, stack_rand, check_nan
+from src.data.components.utils import (
+    check_nan,
+    generate_label,
+    generate_label_window,
+    normalize_waveform,
+    stack_rand,
+)
 
 log = utils.get_pylogger(__name__)
 
@@ -21,7 +30,7 @@ class Ai4epsDataset(Dataset):
     def __init__(
         self,
         data_dir: Path,
-        index_to_waveform_id: List[Tuple[str, str]] = [],
+        index_to_waveform_id: Union[List[Tuple[str, str]], np.ndarray] = [],
         transform: Optional[Callable] = None,
         label_shape: str = "gaussian",
         label_width_in_npts: int = 120,
@@ -29,11 +38,13 @@ class Ai4epsDataset(Dataset):
         phases: List[str] = ["P", "S", "PS"],
         first_arrival_index_in_final_window_if_no_shift: int = 400,
         random_stack_two_waveforms_ratio=0.0,
+        chunk_cache_bytes: int = 16 * 1024**2,
+        packed_waveform: bool = False,
     ):
         """
         Args:
             data_dir (Path): the directory of the dataset
-            index_to_waveform_id (List[Tuple[str, str]], optional): list of tuples, each tuple is (event_id, station_id). Defaults to []. Only the waveforms in the list will be used.
+            index_to_waveform_id (Union[List[Tuple[str, str]], np.ndarray], optional): list of tuples or NX2 array, each row is (event_id, station_id). Defaults to []. Only the waveforms in the list will be used.
             transform (Optional[Callable], optional): Optional transform to be applied on a sample. Defaults to None.
             label_shape (str, optional): the shape of the label, can be "gaussian" or "triangle". Defaults to "gaussian".
             label_width_in_npts (int, optional): the width of the label in number of points. Defaults to 120.
@@ -41,25 +52,55 @@ class Ai4epsDataset(Dataset):
             phases (List[str], optional): list of phases. Defaults to ["P", "S", "PS"].
             first_arrival_index_in_final_window_if_no_shift (int, optional): the index of the first arrival in the final window if no shift. Defaults to 400.
             random_stack_two_waveforms_ratio (float, optional): the ratio of stacking two waveforms. Defaults to 0.0.
+            chunk_cache_bytes (int, optional): the raw data chunk cache size of the packed hdf5 file in bytes. Defaults to 16 MiB.
+            packed_waveform (bool, optional): read from waveform_packed.h5 generated by scripts/repack_ai4eps.py. Defaults to False.
         """
         self.transform = transform
         self.label_shape = label_shape
         self.label_width_in_npts = label_width_in_npts
+        # the label window only depends on the label shape and width, so build it once
+        self.label_window = generate_label_window(label_shape, label_width_in_npts)
         self.window_length_in_npts = window_length_in_npts
         self.phases = phases
         self.first_arrival_index_in_final_window_if_no_shift = (
             first_arrival_index_in_final_window_if_no_shift
         )
         self.random_stack_two_waveforms_ratio = random_stack_two_waveforms_ratio
+        self.chunk_cache_bytes = chunk_cache_bytes
 
         # waveform.h5 is a hdf5 file containing waveform data
         # eg. f["11_52111"]["A01"][...] is a 3XNT numpy array
         # f["11_52111"]["A01"].attrs is the attributes of the waveform
         self.h5py_dir = data_dir / "waveform"
         self._handler = {}
-        # index_to_waveform_id is a list of tuples, each tuple is (event_id, station_id)
+        # index_to_waveform_id is a list of tuples or a NX2 array, each row is (event_id, station_id)
         # eg. [("11_52111", "A01"), ("11_52111", "A02"), ...]
-        self.index_to_waveform_id = index_to_waveform_id
+        # it's stored as two columns, which is cheaper to index and to pickle to the dataloader workers
+        waveform_ids = np.asarray(index_to_waveform_id, dtype=object).reshape(-1, 2)
+        self._event_ids = waveform_ids[:, 0]
+        self._station_ids = waveform_ids[:, 1]
+        # the attributes of the waveforms are kept in fixed width arrays, so there are no per index python objects
+        # phase types are stored as the index in self.phases, -1 if the phase type is not in self.phases
+        # networks are stored as the index in self._networks
+        # hdf5 attribute access is slow, so the per event files are read once per index in load_waveform_attrs
+        num_waveforms = len(self._event_ids)
+        self._phase_code = {phase: code for code, phase in enumerate(phases)}
+        self._phase_count = np.full(num_waveforms, -1, dtype=np.int64)  # -1 if not read yet
+        self._phase_index_arr = np.full((num_waveforms, len(phases)), -999999999, dtype=np.int64)
+        self._phase_type_idx = np.full((num_waveforms, len(phases)), -1, dtype=np.int8)
+        self._min_phase_index = np.zeros(num_waveforms, dtype=np.int64)
+        self._network_code = np.zeros(num_waveforms, dtype=np.int32)
+        self._networks: List[str] = []
+        self._network_to_code: Dict[str, int] = {}
+
+        # waveform_packed.h5 stores all waveforms in a single NX3XNT dataset "waveforms", one chunk per waveform
+        # the attributes are stored as sidecar datasets, so they are loaded into the attribute arrays once here
+        self.packed_waveform = packed_waveform
+        self.packed_h5py_path = data_dir / "waveform_packed.h5"
+        self._packed_handler: Optional[h5py.File] = None
+        self._packed_waveforms: Optional[h5py.Dataset] = None
+        if self.packed_waveform:
+            self.load_packed_index()
 
     def get_handler(self, event_id) -> h5py.File:
         """
@@ -67,15 +108,132 @@ class Ai4epsDataset(Dataset):
             h5py.File: the handler of the hdf5 file
         """
         if event_id not in self._handler:
+            # per event handlers are never closed, so they keep the default chunk cache
             self._handler[event_id] = h5py.File(self.h5py_dir / (event_id + ".h5"), "r")
         return self._handler[event_id]
 
+    def get_packed_handler(self) -> h5py.File:
+        """
+        Returns:
+            h5py.File: the handler of the packed hdf5 file
+        """
+        if self._packed_handler is None:
+            # the default 1 MiB chunk cache is smaller than a single chunk for long waveforms,
+            # which silently disables caching; nslots should be a prime number
+            self._packed_handler = h5py.File(
+                self.packed_h5py_path,
+                "r",
+                rdcc_nbytes=self.chunk_cache_bytes,
+                rdcc_nslots=10007,
+                rdcc_w0=0.75,
+            )
+            # open the waveforms dataset once, instead of looking up the link for every sample
+            self._packed_waveforms = self._packed_handler["waveforms"]  # type: ignore
+        return self._packed_handler
+
+    def load_packed_index(self) -> None:
+        """
+        Map the (event_id, station_id) of each index to rows of the packed file, and load the sidecar datasets of these rows
+        into the attribute arrays.
+        """
+        with h5py.File(self.packed_h5py_path, "r") as f:
+            event_ids = f["event_id"].asstr()[...]  # type: ignore
+            station_ids = f["station_id"].asstr()[...]  # type: ignore
+            key_to_row = {key: row for row, key in enumerate(zip(event_ids, station_ids))}
+            rows = np.array(
+                [
+                    key_to_row[(event_id, station_id)]
+                    for event_id, station_id in zip(self._event_ids, self._station_ids)
+                ],
+                dtype=np.int64,
+            )
+            self._packed_rows = rows
+            self._packed_npts = f["npts"][...][rows]  # type: ignore
+            networks = f["network"].asstr()[...][rows]  # type: ignore
+            self._phase_count = f["phase_count"][...][rows]  # type: ignore
+            self._phase_index_arr = f["phase_index"][...][rows]  # type: ignore
+            phase_type = f["phase_type"].asstr()[...][rows]  # type: ignore
+
+        self._phase_type_idx = np.full(phase_type.shape, -1, dtype=np.int8)
+        for phase, code in self._phase_code.items():
+            self._phase_type_idx[phase_type == phase] = code
+        unique_networks, self._network_code = np.unique(networks, return_inverse=True)
+        self._networks = unique_networks.tolist()
+        self._network_to_code = {network: code for code, network in enumerate(self._networks)}
+        # the first arrival index of each waveform, ignoring the padding of phase_index
+        is_valid = np.arange(self._phase_index_arr.shape[1]) < self._phase_count[:, None]
+        self._min_phase_index = np.where(
+            is_valid, self._phase_index_arr, np.iinfo(np.int64).max
+        ).min(axis=1)
+
+    def __getstate__(self) -> dict:
+        """
+        Returns:
+            dict: the state of the dataset without opened hdf5 handlers, which can not be shared between processes
+        """
+        state = self.__dict__.copy()
+        state["_handler"] = {}
+        state["_packed_handler"] = None
+        state["_packed_waveforms"] = None
+        return state
+
+    @staticmethod
+    def worker_init_fn(worker_id: int, rank: Optional[int] = None) -> None:
+        """
+        Drop the hdf5 handlers a forked dataloader worker inherits from the main process, so each worker opens its own.
+        Then seed the dataloader worker and open the packed hdf5 file when the worker starts, instead of on the first batch.
+        Lightning only seeds the workers with seed_everything(workers=True) if no worker_init_fn is set, so it's chained here.
+        Use it together with persistent_workers=True, so the handlers and cached attributes survive across epochs.
+        Args:
+            worker_id (int): the id of the dataloader worker
+            rank (Optional[int], optional): the global rank of the process. Defaults to None.
+        """
+        # __getstate__ only runs with spawn, with fork the handlers opened in the main process are shared
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            worker_info.dataset._handler = {}  # type: ignore
+            worker_info.dataset._packed_handler = None  # type: ignore
+            worker_info.dataset._packed_waveforms = None  # type: ignore
+        if int(os.environ.get("PL_SEED_WORKERS", 0)):
+            pl_worker_init_function(worker_id, rank=rank)
+        if worker_info is not None and worker_info.dataset.packed_waveform:  # type: ignore
+            worker_info.dataset.get_packed_handler()  # type: ignore
+
+    def load_waveform_attrs(self, idx) -> None:
+        """
+        Read the attributes of the waveform from the per event hdf5 file into the attribute arrays, once per index.
+        Args:
+            idx (int): the index of the waveform
+        """
+        if self._phase_count[idx] >= 0:
+            return
+        event_id, station_id = self._event_ids[idx], self._station_ids[idx]
+        attrs = self.get_handler(event_id)[event_id][station_id].attrs  # type: ignore
+        phase_index = np.asarray(attrs["phase_index"], dtype=np.int64)
+        count = len(phase_index)
+        if count > self._phase_index_arr.shape[1]:
+            # widen the arrays if the waveform has more picks than the current width
+            pad_width = ((0, 0), (0, count - self._phase_index_arr.shape[1]))
+            self._phase_index_arr = np.pad(self._phase_index_arr, pad_width, constant_values=-999999999)
+            self._phase_type_idx = np.pad(self._phase_type_idx, pad_width, constant_values=-1)
+        self._phase_index_arr[idx, :count] = phase_index
+        self._phase_type_idx[idx, :count] = [
+            self._phase_code.get(phase, -1) for phase in attrs["phase_type"].tolist()  # type: ignore
+        ]
+        self._min_phase_index[idx] = phase_index.min()
+        network = str(attrs["network"])
+        if network not in self._network_to_code:
+            self._network_to_code[network] = len(self._networks)
+            self._networks.append(network)
+        self._network_code[idx] = self._network_to_code[network]
+        self._phase_count[idx] = count
+
     def __len__(self) -> int:
         """
         Returns:
             int: the total number of waveforms in the dataset
         """
-        return len(self.index_to_waveform_id)
+        return len(self._event_ids)
 
     def get_item_without_stack(self, idx) -> dict:
         """
@@ -84,61 +242,73 @@ class Ai4epsDataset(Dataset):
         Returns:
             dict: a sample containing waveform data, phase index, phase type, event id, network, station id
         """
-        event_id, station_id = self.index_to_waveform_id[idx]
-        handler = self.get_handler(event_id)
-        waveform = torch.tensor(handler[event_id][station_id][...], dtype=torch.float32)  # type: ignore
+        phases = self.phases
+        first_arrival_index = self.first_arrival_index_in_final_window_if_no_shift
+        event_id, station_id = self._event_ids[idx], self._station_ids[idx]
+        if self.packed_waveform:
+            if self._packed_waveforms is None:
+                self.get_packed_handler()
+            dset = self._packed_waveforms
+            row, npts = int(self._packed_rows[idx]), int(self._packed_npts[idx])
+        else:
+            dset = self.get_handler(event_id)[event_id][station_id]  # type: ignore
+            row, npts = None, dset.shape[-1]  # type: ignore
+            self.load_waveform_attrs(idx)
+        count = self._phase_count[idx]
+        phase_index = self._phase_index_arr[idx, :count]
+        phase_type_idx = self._phase_type_idx[idx, :count]
+        network = self._networks[self._network_code[idx]]
+        start_index = int(self._min_phase_index[idx]) - first_arrival_index
+        end_index = start_index + self.window_length_in_npts
+
+        if self.transform:
+            # transforms shift the waveform and take noise outside of the window, so they need the full trace
+            waveform = torch.from_numpy(_read_window(dset, 0, npts, row, npts)).float()  # type: ignore
+        else:
+            # only read the chunks overlapping with the final window
+            waveform = torch.from_numpy(
+                _read_window(dset, start_index, end_index, row, npts)  # type: ignore
+            ).float()
         if torch.isnan(waveform).any():
             waveform[torch.isnan(waveform)] = 0.0
             log.info(
                 f"waveform contains nan, set to 0.0, event_id: {event_id}, station_id: {station_id}"
             )
-        attrs = handler[event_id][station_id].attrs  # type: ignore
 
         sample = {
-            "key": f"{event_id}_{attrs['network']}.{station_id}",
+            "key": f"{event_id}_{network}.{station_id}",
             "data": waveform,
-            "phase_index": attrs["phase_index"].tolist(),  # type: ignore
-            "phase_type": attrs["phase_type"].tolist(),  # type: ignore
+            "phase_index": phase_index,
         }
-        min_index = min(sample["phase_index"])
-        start_index, end_index = (
-            min_index - self.first_arrival_index_in_final_window_if_no_shift,
-            min_index
-            - self.first_arrival_index_in_final_window_if_no_shift
-            + self.window_length_in_npts,
-        )
 
         # used by transforms to indicate the start and end index of the window
         sample["start_index"] = start_index
         sample["end_index"] = end_index
 
         if self.transform:
+            # transforms work on python lists
+            sample["phase_index"] = phase_index.tolist()
             sample = self.transform(sample)
-
-        # cut sample['data'] to the window length
-        sample["data"] = sample["data"][:, start_index:end_index]
+            # cut sample['data'] to the window length
+            sample["data"] = sample["data"][:, start_index:end_index]
         # shift the phase index to the window length
-        sample["phase_index"] = [i - start_index for i in sample["phase_index"]]
-        # generate label, arrivals should be in order as self.phases, if not exist, use -1
-        expanded_phase_index = []
-        for phase in self.phases:
-            if phase in sample["phase_type"]:
-                expanded_phase_index.append(
-                    sample["phase_index"][sample["phase_type"].index(phase)]
-                )
-            else:
-                expanded_phase_index.append(-999999999)
+        shifted_phase_index = np.asarray(sample["phase_index"], dtype=np.int64) - start_index
+        # generate label, arrivals should be in order as self.phases, if not exist, use -999999999
+        # np.unique returns the first pick if a phase type is duplicated
+        expanded_phase_index = np.full(len(phases), -999999999, dtype=np.int64)
+        codes, first_pick = np.unique(phase_type_idx, return_index=True)
+        is_known = codes >= 0
+        expanded_phase_index[codes[is_known]] = shifted_phase_index[first_pick[is_known]]
+        # keep phase_index as a numpy array, ai4eps_collate converts it to a BX(number of phases) tensor once per batch
         sample["phase_index"] = expanded_phase_index
-        sample["phase_type"] = self.phases
-        # convert phase_idnex to tensor, otherwise in dataloader, it will be converted to list with wrong shape
-        # eg: using list: 3X8 if batch_size=8, using tensor: 8X3
-        sample["phase_index"] = torch.tensor(sample["phase_index"])
+        sample["phase_type"] = phases
 
         sample["label"] = generate_label(
             self.label_shape,
             self.label_width_in_npts,
             self.window_length_in_npts,
             sample["phase_index"],
+            self.label_window,
         )
         # normalize the data before possible stacking
         sample = normalize_waveform(sample)
@@ -155,15 +325,15 @@ class Ai4epsDataset(Dataset):
         # the difference between get_item_without_stack and __getitem__ is that get_item_without_stack does not stack two waveforms
         # the stack ratio can be obtained by self.random_stack_two_waveforms_ratio
         current_sample = self.get_item_without_stack(idx)
-        if torch.rand(1) < self.random_stack_two_waveforms_ratio:
-            random_idx = torch.randint(0, len(self), (1,)).item()
+        if random.random() < self.random_stack_two_waveforms_ratio:
+            random_idx = random.randrange(len(self))
             random_sample = self.get_item_without_stack(random_idx)
             current_sample = stack_rand(
                 current_sample, random_sample, self.label_width_in_npts
             )
+            # normalize the stacked data, samples without stacking are already normalized
+            current_sample = normalize_waveform(current_sample)
 
-        # normalize the data at the end
-        current_sample = normalize_waveform(current_sample)
         # replace nan in data
         current_sample = check_nan(current_sample)
         # remove unused keys, including start_index, end_index
@@ -173,12 +343,72 @@ class Ai4epsDataset(Dataset):
         return current_sample
 
 
+def _read_window(
+    dset: h5py.Dataset,
+    start_index: int,
+    end_index: int,
+    row: Optional[int] = None,
+    npts: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Read the [start_index, end_index) window of a waveform dataset, so only the overlapping chunks are read from disk.
+    Args:
+        dset (h5py.Dataset): the 3XNT waveform dataset, or the NX3XNT dataset in the packed file
+        start_index (int): the start index of the window, can be negative
+        end_index (int): the end index of the window, can be larger than NT
+        row (Optional[int], optional): the row of the waveform in the packed dataset. Defaults to None.
+        npts (Optional[int], optional): the number of valid points of the waveform. Defaults to NT.
+    Returns:
+        np.ndarray: the float32 (or float16 for float16 storage) window, the part outside of the waveform is padded with zeros
+    """
+    selection = () if row is None else (row,)
+    nt = dset.shape[-1] if npts is None else npts
+    read_start, read_end = max(start_index, 0), min(end_index, nt)
+    # read into the buffer directly so HDF5 does any type conversion and torch.from_numpy can share it
+    # float16 storage is kept as is, and converted by torch in a single pass afterwards
+    dtype = np.float16 if dset.dtype == np.float16 else np.float32
+    shape = (dset.shape[-2], end_index - start_index)
+    if read_start == start_index and read_end == end_index:
+        window = np.empty(shape, dtype=dtype)
+    else:
+        window = np.zeros(shape, dtype=dtype)
+    if read_start >= read_end:
+        return window
+
+    # use the low level api to read the hyperslab, which skips the selection parsing in read_direct
+    nchannel, count = shape[0], read_end - read_start
+    file_space = dset.id.get_space()
+    file_space.select_hyperslab(
+        selection + (0, read_start), (1,) * len(selection) + (nchannel, count)
+    )
+    memory_space = h5py.h5s.create_simple(shape)
+    memory_space.select_hyperslab((0, read_start - start_index), (nchannel, count))
+    dset.id.read(memory_space, file_space, window)
+    return window
+
+
+def ai4eps_collate(batch: List[dict]) -> dict:
+    """
+    Args:
+        batch (List[dict]): list of samples from Ai4epsDataset
+    Returns:
+        dict: the collated batch, phase_index is stacked into a BX(number of phases) tensor
+    """
+    # stack phase_index with numpy once per batch, otherwise default_collate converts each sample to a tensor first
+    phase_index = torch.from_numpy(np.stack([sample["phase_index"] for sample in batch]))
+    collated = default_collate(
+        [{key: value for key, value in sample.items() if key != "phase_index"} for sample in batch]
+    )
+    collated["phase_index"] = phase_index
+    return collated
+
+
 def split_train_test_val_for_ai4eps(
     data_dir: Path,
     ratio: List[float] = [0.9, 0.05, 0.05],
     seed: int = 3407,
     split_based_on: str = "S",
-) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]], List[Tuple[str, str]]]:
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Split the dataset into train, test, and val set
     Args:
@@ -187,22 +417,20 @@ def split_train_test_val_for_ai4eps(
         seed (int, optional): the seed for random shuffle. Defaults to 3407.
         split_based_on (str, optional): the phase type as reference to split the dataset. Defaults to "S".
     Returns:
-        Tuple[List[Tuple[str, str]], List[Tuple[str, str]], List[Tuple[str, str]]]: train, test, and val set
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: train, test, and val set, each is a NX2 array of (event_id, station_id)
     """
 
     def extract_unique_pairs(
         phase_picks: pd.DataFrame, split_based_on: str
     ) -> Tuple[set, set]:
-        unique_pairs_set = set()
-        unique_pairs_set_other = set()
+        is_reference = (phase_picks["phase_type"] == split_based_on).to_numpy()
+        event_ids = phase_picks["event_id"].to_numpy()
+        station_ids = phase_picks["station_id"].to_numpy()
 
-        def get_unique_pairs(row):
-            if row["phase_type"] == split_based_on:
-                unique_pairs_set.add((row["event_id"], row["station_id"]))
-            else:
-                unique_pairs_set_other.add((row["event_id"], row["station_id"]))
-
-        phase_picks.apply(get_unique_pairs, axis=1)  # type: ignore
+        unique_pairs_set = set(zip(event_ids[is_reference], station_ids[is_reference]))
+        unique_pairs_set_other = set(
+            zip(event_ids[~is_reference], station_ids[~is_reference])
+        )
         unique_pairs_set_other -= unique_pairs_set
 
         return unique_pairs_set, unique_pairs_set_other
@@ -236,10 +464,17 @@ def split_train_test_val_for_ai4eps(
             val_pairs + val_pairs_other,
         )
 
-    phase_picks = pd.read_csv(data_dir / "phase_picks.csv")
-    # event_id column to str type
-    phase_picks["event_id"] = phase_picks["event_id"].astype("str")
+    # only parse the columns used for splitting, event_id is read as str type
+    phase_picks = pd.read_csv(
+        data_dir / "phase_picks.csv",
+        usecols=["event_id", "station_id", "phase_type"],
+        dtype={"event_id": str, "station_id": str, "phase_type": str},
+    )
     unique_pairs = extract_unique_pairs(phase_picks, split_based_on)
     train_pairs, test_pairs, val_pairs = split_pairs(unique_pairs, ratio, seed)
 
-    return train_pairs, test_pairs, val_pairs
+    return (
+        np.asarray(train_pairs, dtype=object).reshape(-1, 2),
+        np.asarray(test_pairs, dtype=object).reshape(-1, 2),
+        np.asarray(val_pairs, dtype=object).reshape(-1, 2),
+    )
@@ -1,24 +1,19 @@
 """
 utils.py: this file contains some utility functions for data processing
 """
-from typing import List
+from typing import List, Optional
 
 import torch
 
 
-def generate_label(
-    label_shape: str, label_width: int, wave_length: int, arrivals: List[int] = []
-) -> torch.Tensor:
+def generate_label_window(label_shape: str, label_width: int) -> torch.Tensor:
     """
     Args:
         label_shape (str): the shape of the label, can be "gaussian" or "triangle"
         label_width (int): the width of the label
-        wave_length (int): the shape of the data (as the same shape as the waveform)
-        arrivals (List[int], optional): list of arrival indices. Defaults to an empty list.
     Returns:
-        torch.Tensor: generated label tensor
+        torch.Tensor: the label window centered at the arrival
     """
-    res = torch.zeros(len(arrivals) + 1, wave_length)
     if label_shape == "gaussian":
         label_window = torch.exp(
             -((torch.arange(-label_width // 2, label_width // 2 + 1)) ** 2)
@@ -30,6 +25,29 @@ def generate_label(
         )
     else:
         raise Exception(f"label shape {label_shape} is not supported!")
+    return label_window
+
+
+def generate_label(
+    label_shape: str,
+    label_width: int,
+    wave_length: int,
+    arrivals: List[int] = [],
+    label_window: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Args:
+        label_shape (str): the shape of the label, can be "gaussian" or "triangle"
+        label_width (int): the width of the label
+        wave_length (int): the shape of the data (as the same shape as the waveform)
+        arrivals (List[int], optional): list of arrival indices. Defaults to an empty list.
+        label_window (Optional[torch.Tensor], optional): precomputed window from generate_label_window. Defaults to None.
+    Returns:
+        torch.Tensor: generated label tensor
+    """
+    res = torch.zeros(len(arrivals) + 1, wave_length)
+    if label_window is None:
+        label_window = generate_label_window(label_shape, label_width)
 
     for i, idx in enumerate(arrivals):
         # the index for arrival times
@@ -39,8 +57,9 @@ def generate_label(
         if start >= 0 and end <= res.shape[1]:
             res[i + 1, start:end] = label_window
 
-    # the first row represents the noise label
-    res[0, :] = 1 - torch.sum(res, 0)
+    # the first row represents the noise label, computed in place to avoid temporaries
+    torch.sum(res[1:], 0, out=res[0])
+    res[0].neg_().add_(1)
     return res
 
 
@@ -74,8 +93,10 @@ def stack_rand(sample: dict, random_sample: dict, label_width: int) -> dict:
     stacked_label = label + random_label
 
     # for label, we need to make sure the sum of possibility to be 1
-    stacked_label = torch.clamp_max(stacked_label, 1.0)
-    stacked_label[0, :] = 1 - torch.sum(stacked_label[1:], 0)
+    # stacked_label is a new tensor, so it's safe to update in place
+    stacked_label.clamp_max_(1.0)
+    torch.sum(stacked_label[1:], 0, out=stacked_label[0])
+    stacked_label[0].neg_().add_(1)
 
     sample.update({"data": stacked_data, "label": stacked_label})
     return sample
@@ -89,12 +110,14 @@ def normalize_waveform(sample: dict) -> dict:
         dict: the normalized sample dict
     """
     data = sample["data"]
-    mean_vals = torch.mean(data, dim=1, keepdim=True)
-    data = data - mean_vals
-    max_std_val = torch.max(torch.std(data, dim=1))
+    # std is invariant to demeaning, so get both statistics from a single reduction
+    std_vals, mean_vals = torch.std_mean(data, dim=1, keepdim=True)
+    max_std_val = torch.max(std_vals)
     if max_std_val == 0:
         max_std_val = torch.ones(1)
-    data = data / max_std_val
+    # only allocate one new tensor, the input data is not modified
+    data = data - mean_vals
+    data.div_(max_std_val)
 
     sample.update({"data": data})
     return sample
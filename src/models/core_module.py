@@ -5,7 +5,7 @@ import torch
 import torch.nn as nn
 from lightning import LightningModule
 
-from src.models.loss.focal_loss import focal_loss
+from src.models.loss.focal_loss import compile_focal_loss, focal_loss
 from src.models.metrics import F1, Precision, Recall
 from src.models.spectrogram import GenSgram
 from src.models.utils.peaks import extract_peaks
@@ -19,6 +19,7 @@ class PhaseNetTFModule(LightningModule):
         optimizer: torch.optim.Optimizer,
         scheduler: torch.optim.lr_scheduler.LRScheduler,
         loss: str = "kl_div",
+        compile_loss: bool = False,
         output_classes_weight: List[float] = [
             0.25,
             0.25,
@@ -49,6 +50,7 @@ class PhaseNetTFModule(LightningModule):
 
         self.net = net
         self.sgram_generator = GenSgram(**sgram_generator_config)
+        self.focal_loss = compile_focal_loss() if compile_loss else focal_loss
 
         self.metrics = self._init_metrics(
             phases, window_length_in_npts, dt_s, metrics_true_positive_threshold_s_list
@@ -132,7 +134,7 @@ class PhaseNetTFModule(LightningModule):
         elif self.hparams["loss"] == "focal":
             # note weighting is not implemented for focal loss
             softmax_pred = nn.functional.softmax(predict, dim=1)
-            loss = focal_loss(softmax_pred, clamped_label)
+            loss = self.focal_loss(softmax_pred, clamped_label)
         else:
             raise NotImplementedError(f"loss {self.hparams['loss']} not implemented")
         return loss
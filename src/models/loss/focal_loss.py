@@ -1,5 +1,15 @@
+import math
+from typing import Callable
+
 import torch
 
+from src import utils
+
+log = utils.get_pylogger(__name__)
+
+# clamp the log input at exp(-100), which bounds the log terms at -100 like F.binary_cross_entropy
+EPS = math.exp(-100)
+
 
 def focal_loss(
     inputs: torch.Tensor, targets: torch.Tensor, alpha: float = 0.8, gamma: float = 2
@@ -19,15 +29,37 @@ def focal_loss(
         loss: A float32 scalar representing normalized total loss.
     """
     # first compute binary cross-entropy
-    x = inputs.view(-1)
-    y = targets.view(-1)
-    BCE = (y - 1) * torch.log(1 - x + 1e-14) - y * torch.log(x + 1e-14)
-    if len(inputs) > 0:
-        BCE = BCE.mean() * inputs.numel() / len(inputs)  # batch mean
-    else:
-        BCE = BCE.mean() * inputs.numel() * 0.0
+    # it's written out instead of F.binary_cross_entropy, which refuses to run under CUDA autocast
+    # float32 keeps EPS representable when the inputs are half precision
+    x = inputs.reshape(-1).float()
+    y = targets.reshape(-1).float()
+    # batch mean, the integer batch size avoids python float scalar arithmetic on the loss
+    batch_size = max(inputs.shape[0], 1)
+    BCE = (
+        (y - 1) * torch.log((1 - x).clamp_min(EPS)) - y * torch.log(x.clamp_min(EPS))
+    ).sum() / batch_size
 
     BCE_EXP = torch.exp(-BCE)
     focal_loss = alpha * (1 - BCE_EXP) ** gamma * BCE
 
     return focal_loss
+
+
+def compile_focal_loss() -> Callable[..., torch.Tensor]:
+    """
+    Fuse the elementwise ops of focal_loss into a single kernel with torch.compile.
+    The graph is compiled with dynamic=False, so it's reused only for the same input shape: the last partial batch
+    of each epoch (the dataloaders don't drop_last) and validation batches of a different size trigger a recompilation.
+
+    Returns:
+        The compiled focal_loss, or the eager focal_loss if torch.compile is not supported.
+    """
+    if not hasattr(torch, "compile"):
+        log.warning("torch.compile is not available, use eager focal_loss")
+        return focal_loss
+    try:
+        return torch.compile(focal_loss, dynamic=False)
+    except RuntimeError as e:
+        # eg. torch 2.0 does not support torch.compile on python 3.11
+        log.warning(f"torch.compile is not supported ({e}), use eager focal_loss")
+        return focal_loss